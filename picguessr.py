@@ -1,20 +1,27 @@
 from __future__ import annotations
 
 import abc
-import copy
+import functools
 import json
 import logging
 import os
+import queue
 import random
-import re
 import sqlite3
 import sys
-import textwrap
-from collections import Counter
-from typing import Any, Iterable, TypedDict
-
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import httpx
+import requests
 from openai import AzureOpenAI, OpenAI
-from telebot import TeleBot
+from requests.adapters import HTTPAdapter
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiTelegramException
+from telebot.custom_filters import SimpleCustomFilter
 from telebot.formatting import escape_markdown
 from telebot.types import BotCommand, Message, User
 
@@ -24,7 +31,7 @@ DEFAULT_CONFIG = {  # TODO: allow to change
     "max_guesses": 5,
     "chat": {
         "model": "gpt-35-turbo",
-        "temperature": 0.5,
+        "temperature": 0,
     },
     "model": "dall-e",
 }
@@ -32,109 +39,282 @@ DEFAULT_CONFIG = {  # TODO: allow to change
 ABSENT = "⬛"
 PRESENT = "🟨"
 CORRECT = "🟩"
+# Maps the per-character codes built in evaluate_guess() to their squares.
+_TOKEN_TABLE = str.maketrans({"\x00": ABSENT, "\x01": PRESENT, "\x02": CORRECT})
 DATA_DIR = os.getenv("DATA_DIR", "data")
 
+# Shared by all games so repeated downloads reuse pooled keep-alive connections.
+http_client = httpx.Client(
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    timeout=httpx.Timeout(10.0),
+)
+
+RECORD_WIN_SQL = (
+    "INSERT INTO scores (userid, chatid, name, score) VALUES (?, ?, ?, 1) "
+    "ON CONFLICT (userid, chatid) DO UPDATE SET score = score + 1, name = excluded.name"
+)
 
-class GameState(TypedDict):
+
+@dataclass(slots=True)
+class GameState:
     answer: str
     remain_guesses: int
-    revealed: list[str]
+    revealed: set[int]  # indices of the answer shown as hints
     min_unrevealed: int
-    game: "GuessGame"
-    context: dict[str, Any]
+    game: GuessGame
+    context: dict[str, Any] = field(default_factory=dict)
+    # Derived from the answer once at game start, for games that need them.
+    normalized_answer: str = ""
+    punctuations: list[tuple[int, str]] = field(default_factory=list)
 
 
 class GameManager:
     def __init__(self) -> None:
         self.is_debug = False
         self._states: dict[str, GameState] = {}
+        self._states_lock = threading.Lock()
         os.makedirs(DATA_DIR, exist_ok=True)
         self._db = os.path.join(DATA_DIR, "game.db")
+        # Handlers run on telebot worker threads, so share one connection
+        # guarded by a lock instead of reconnecting for every query.
+        self._conn = sqlite3.connect(
+            self._db,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        self._conn.executescript(
+            "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY;"
+        )
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=32)
+        # Pending tasks per chat, drained in order by one pool task at a time.
+        self._chat_queues: dict[int, deque[Callable[[], None]]] = {}
+        self._chat_queues_lock = threading.Lock()
+        self._inflight: dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
         self._init_db()
 
     def set_debug(self, is_debug: bool) -> None:
         self.is_debug = is_debug
 
     def _init_db(self):
-        with sqlite3.connect(self._db) as conn:
-            conn.execute(
-                textwrap.dedent("""
+        with self._lock:
+            self._conn.executescript("""
                 CREATE TABLE IF NOT EXISTS scores (
                     userid INTEGER NOT NULL,
                     chatid INTEGER NOT NULL,
                     name TEXT,
                     score INTEGER DEFAULT 0,
                     PRIMARY KEY (userid, chatid)
-                )
-                """)
-            )
-            conn.commit()
+                );
+                CREATE INDEX IF NOT EXISTS idx_scores_chat_score
+                    ON scores (chatid, score DESC, userid);
+                CREATE TABLE IF NOT EXISTS prompts (
+                    key TEXT PRIMARY KEY,
+                    prompt TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS images (
+                    key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL
+                );
+            """)
 
     def start_game(self, chat_id: int, state: GameState) -> GameState:
         logger.info("Starting a new game in chat %d", chat_id)
-        self._states[chat_id] = state
+        with self._states_lock:
+            self._states[chat_id] = state
         return state
 
+    def submit(self, chat_id: int | None, fn: Callable[..., Any], *args: Any) -> Future:
+        """Run fn on the worker pool, serialized with other work in the same chat.
+
+        Pass ``None`` as chat_id for work that needs no serialization.
+        """
+        if chat_id is None:
+            return self._executor.submit(fn, *args)
+        future: Future = Future()
+
+        def run() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with self._chat_queues_lock:
+            pending = self._chat_queues.get(chat_id)
+            if pending is None:
+                self._chat_queues[chat_id] = deque([run])
+                self._executor.submit(self._drain_chat, chat_id)
+            else:
+                pending.append(run)
+        return future
+
+    def _drain_chat(self, chat_id: int) -> None:
+        # Only one drainer exists per chat, so its tasks run in submission order
+        # and a busy chat occupies a single worker.
+        while True:
+            with self._chat_queues_lock:
+                pending = self._chat_queues[chat_id]
+                if not pending:
+                    del self._chat_queues[chat_id]
+                    return
+                run = pending.popleft()
+            run()
+
+    def coalesce(self, key: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """Call fn, sharing the result with concurrent callers using the same key."""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._inflight[key] = Future()
+        if not is_owner:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
     def get_state(self, chat_id: int) -> GameState | None:
         return self._states.get(chat_id)
 
-    def clear_state(self, chat_id: int) -> None:
-        self._states.pop(chat_id, None)
+    def is_current(self, chat_id: int, state: GameState) -> bool:
+        return self._states.get(chat_id) is state
+
+    def clear_state(self, chat_id: int, state: GameState | None = None) -> bool:
+        """End the chat's game, or only the given game if it is still the current one.
+
+        Return whether a game was removed.
+        """
+        with self._states_lock:
+            if state is not None and self._states.get(chat_id) is not state:
+                return False
+            return self._states.pop(chat_id, None) is not None
 
     def record_win(self, user: User, chat_id: int) -> None:
-        with sqlite3.connect(self._db) as conn:
-            conn.execute(
-                "INSERT OR REPLACE INTO scores (userid, chatid, name, score) VALUES (?, ?, ?, COALESCE((SELECT score FROM scores WHERE userid = ?), 0) + 1)",
-                (user.id, chat_id, user.full_name, user.id),
+        with self._lock:
+            self._conn.execute(RECORD_WIN_SQL, (user.id, chat_id, user.full_name))
+
+    def get_prompt(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT prompt FROM prompts WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_prompt(self, key: str, prompt: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO prompts (key, prompt) VALUES (?, ?)",
+                (key, prompt),
             )
-            conn.commit()
 
-    def get_scores(self, chat_id: int) -> Iterable[tuple[int, str, int]]:
-        with sqlite3.connect(self._db) as conn:
-            cur = conn.execute(
-                "SELECT userid, name, score FROM scores WHERE chatid = ?", (chat_id,)
+    def get_image(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM images WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_image(self, key: str, file_id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO images (key, file_id) VALUES (?, ?)",
+                (key, file_id),
+            )
+
+    def delete_image(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM images WHERE key = ?", (key,))
+
+    def get_scores(self, chat_id: int, limit: int = 20) -> list[tuple[int, str, int]]:
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT userid, name, score FROM scores WHERE chatid = ? "
+                "ORDER BY score DESC, userid LIMIT ?",
+                (chat_id, limit),
             )
             return cur.fetchall()
 
+    def get_rank(self, user_id: int, chat_id: int) -> tuple[int, int] | None:
+        """Return the (rank, score) of the user in the chat, if they have scored.
+
+        Ties are broken by userid, the same order get_scores() lists them in.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM scores WHERE chatid = s.chatid "
+                "AND (score > s.score OR (score = s.score AND userid < s.userid)))"
+                " + 1, s.score FROM scores AS s WHERE s.userid = ? AND s.chatid = ?",
+                (user_id, chat_id),
+            ).fetchone()
+
+
+def download_file(url: str, path: str) -> None:
+    response = http_client.get(url)
+    response.raise_for_status()
+    # Write to a temporary file first so a failed download never leaves
+    # a truncated database behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(response.content)
+    os.replace(tmp_path, path)
+
 
 def evaluate_guess(guess: str, answer: str) -> str:
-    result = [""] * len(answer)
-    counter = Counter(answer)
-    for i, l in enumerate(answer):
-        if i >= len(guess):
-            result[i] = ABSENT
-        elif guess[i] == l:
-            result[i] = CORRECT
-            counter[l] -= 1
-    for i, l in enumerate(guess):
-        if i >= len(result) or result[i]:
-            continue
-        elif counter.get(l, 0) > 0:
-            result[i] = PRESENT
-            counter[l] -= 1
+    codes = bytearray(len(answer))  # all ABSENT
+    remaining: dict[str, int] = {}
+    pending: list[int] = []
+    for i, (g, a) in enumerate(zip(guess, answer)):
+        if g == a:
+            codes[i] = 2
         else:
-            result[i] = ABSENT
-    return "".join(result)
+            remaining[a] = remaining.get(a, 0) + 1
+            pending.append(i)
+    # Answer letters past the end of the guess can still be matched elsewhere.
+    for a in answer[len(guess) :]:
+        remaining[a] = remaining.get(a, 0) + 1
+    for i in pending:
+        l = guess[i]
+        if remaining.get(l, 0) > 0:
+            codes[i] = 1
+            remaining[l] -= 1
+    return codes.decode("ascii").translate(_TOKEN_TABLE)
 
 
 game_manager = GameManager()
-bot = TeleBot(token=os.environ["BOT_TOKEN"])
-me = bot.get_me()
+# Handlers only queue work on game_manager, so dispatch them inline in the polling
+# thread. Tasks are then queued in arrival order, and GameManager.submit() runs
+# each chat's queue in that order.
+bot = TeleBot(token=os.environ["BOT_TOKEN"], threaded=False)
 
 
 def handle_exception(f):
     import inspect
 
+    # Inspect once at decoration time rather than on every message.
+    has_self = "self" in inspect.signature(f).parameters
+
+    @functools.wraps(f)
     def wrapper(*args, **kwargs):
-        parameters = inspect.signature(f).parameters
-        if "self" in parameters:
-            message = args[1]
-        else:
-            message = args[0]
+        message = args[1] if has_self else args[0]
         try:
-            logger.debug(
-                "New message from %s chat: %s", message.chat.type, message.chat.id
-            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "New message from %s chat: %s", message.chat.type, message.chat.id
+                )
             return f(*args, **kwargs)
         except Exception as e:
             logger.exception(e)
@@ -143,13 +323,146 @@ def handle_exception(f):
     return wrapper
 
 
+def run_in_worker(f):
+    """Dispatch the handler to the worker pool so slow games don't block polling."""
+
+    @functools.wraps(f)
+    def wrapper(*args):
+        message = args[-1]
+        game_manager.submit(message.chat.id, f, *args)
+
+    return wrapper
+
+
+class ReplyToBotFilter(SimpleCustomFilter):
+    """Match messages that reply to one of the bot's own messages."""
+
+    key = "reply_to_bot"
+
+    def __init__(self, bot_id: int) -> None:
+        self.bot_id = bot_id
+
+    def check(self, message: Message) -> bool:
+        reply = message.reply_to_message
+        return reply is not None and reply.from_user.id == self.bot_id
+
+
 class GuessGame(abc.ABC):
+    # Namespaces this game's entries in the shared prompt and image caches.
+    CACHE_PREFIX: str
+    # System prompt asking the chat model to describe a word as an image prompt.
+    IMAGE_PROMPT_INSTRUCTIONS: str
+
     def __init__(self, openai_client: OpenAI) -> None:
         self.openai_client = openai_client
-        self.config = copy.deepcopy(DEFAULT_CONFIG)
+        self.config = {**DEFAULT_CONFIG, "chat": dict(DEFAULT_CONFIG["chat"])}
 
     def render_answer(self, state: GameState) -> str:
-        return state["answer"]
+        return state.answer
+
+    # Games live as long as the process, so holding self in the cache is fine.
+    @functools.lru_cache(maxsize=2048)
+    def get_image_prompt(self, word: str) -> str:
+        """Return the image prompt for word, asking the chat model only on a miss."""
+        chat = self.config["chat"]
+        cache_key = (
+            f"{self.CACHE_PREFIX}:{chat['model']}:{chat['temperature']}:{word}"
+        )
+        prompt = game_manager.get_prompt(cache_key)
+        if prompt is None:
+            prompt = self.make_image_prompt(word)
+            game_manager.save_prompt(cache_key, prompt)
+        return prompt
+
+    def image_cache_key(self, word: str) -> str:
+        return f"{self.CACHE_PREFIX}:{self.config['model']}:{word}"
+
+    def send_image(
+        self,
+        chat_id: int,
+        state: GameState,
+        caption: str,
+        photo: str | bytes | None = None,
+    ) -> None:
+        """Send the picture for the game, reusing an already uploaded one if possible.
+
+        Nothing is sent if the game has ended or been replaced in the meantime.
+        A ready image URL or image content may be passed as photo to skip generation.
+        """
+        word = state.answer
+        cache_key = self.image_cache_key(word)
+        file_id = game_manager.get_image(cache_key)
+        if file_id is not None:
+            if not game_manager.is_current(chat_id, state):
+                return
+            try:
+                # Telegram resends a known file_id without any upload or generation.
+                bot.send_photo(chat_id, file_id, caption=caption)
+            except ApiTelegramException as e:
+                # file_ids only work for the bot that uploaded them, e.g. after a
+                # token change; forget this one and draw the picture again.
+                # Any other failure (rate limits, kicked bot) is not the file's fault.
+                if e.error_code != 400 or "file identifier" not in e.description:
+                    raise
+                logger.warning("Cached photo for %s is unusable: %s", word, e)
+                game_manager.delete_image(cache_key)
+            else:
+                return
+        if photo is None:
+            # Games starting on the same word at once share a single generation.
+            photo = game_manager.coalesce(cache_key, self.generate_image, word)
+        if not game_manager.is_current(chat_id, state):
+            return
+        sent = bot.send_photo(chat_id, photo, caption=caption)
+        game_manager.save_image(cache_key, sent.photo[-1].file_id)
+
+    @handle_exception
+    def send_question(
+        self,
+        message: Message,
+        state: GameState,
+        caption: str,
+        prepare: Future,
+        photo: str | bytes | None = None,
+    ) -> None:
+        """Send the picture for a new game, then remove the "preparing" notice."""
+        try:
+            self.send_image(message.chat.id, state, caption, photo)
+        except Exception as e:
+            # This task runs outside the chat queue; leave any newer game alone.
+            if not game_manager.clear_state(message.chat.id, state):
+                logger.warning("Dropped picture of an ended game: %s", e)
+                return
+            if "content_policy_violation" in str(e):
+                bot.reply_to(
+                    message, "生成图片失败，可能是因为内容不符合政策，请重试。"
+                )
+            else:
+                raise
+        else:
+            prepare_message = prepare.result()
+            bot.delete_message(prepare_message.chat.id, prepare_message.message_id)
+
+    def make_image_prompt(self, word: str) -> str:
+        # Keep the instructions as a fixed prefix and the word last, so the
+        # request is identical up to the word and can hit provider prompt caching.
+        response = self.openai_client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": self.IMAGE_PROMPT_INSTRUCTIONS},
+                {"role": "user", "content": word},
+            ],
+            **self.config["chat"],
+        )
+        content = response.choices[0].message.content
+        logger.debug("Image prompt for %s: %s", word, content)
+        if not content:
+            # Raise instead of returning, so neither cache keeps the empty answer.
+            raise RuntimeError("Failed to generate image prompt")
+        return content
+
+    @abc.abstractmethod
+    def generate_image(self, word: str) -> str:
+        pass
 
     @abc.abstractmethod
     def add_to_bot(self, bot: TeleBot) -> None:
@@ -169,15 +482,54 @@ class GuessIdiom(GuessGame):
         "https://cdn.jsdelivr.net/gh/cheeaun/chengyu-wordle/data/THUOCL_chengyu.txt"
     )
     IDIOM_FILE = os.path.join(DATA_DIR, "idioms.txt")
+    CACHE_PREFIX = "idiom"
+    IMAGE_PROMPT_INSTRUCTIONS = "Explain the given chinese idiom to plain text."
 
     def __init__(self, openai_client: OpenAI) -> None:
         super().__init__(openai_client)
         self.idioms = self._load_idioms()
+        self.total = len(self.idioms)
         self.config["min_unrevealed"] = 1
+        # Idiom and picture for the next game, drawn while the current one is played.
+        self._prefetched: queue.Queue[tuple[str, bytes]] = queue.Queue(maxsize=1)
+        self._prefetching = threading.Lock()
+
+    def _prefetch(self) -> None:
+        """Draw the picture for the next game in advance.
+
+        The image is downloaded instead of kept as a URL: generated URLs expire,
+        and a quiet chat would otherwise discard pictures it paid for.
+        """
+        try:
+            idiom = self.idioms[random.randrange(self.total)]
+            cache_key = self.image_cache_key(idiom)
+            if game_manager.get_image(cache_key) is not None:
+                # Picking it at random later sends it just as fast.
+                return
+            image_url = game_manager.coalesce(cache_key, self.generate_image, idiom)
+            response = http_client.get(image_url)
+            response.raise_for_status()
+            self._prefetched.put_nowait((idiom, response.content))
+        except Exception:
+            logger.exception("Failed to prefetch the next idiom picture")
+        finally:
+            self._prefetching.release()
+
+    def _next_idiom(self) -> tuple[str, bytes | None]:
+        try:
+            idiom, photo = self._prefetched.get_nowait()
+        except queue.Empty:
+            idiom, photo = self.idioms[random.randrange(self.total)], None
+        # Refill only as games consume pictures, one at a time, so nothing is
+        # drawn at startup or piled up for games that may never be played.
+        if self._prefetching.acquire(blocking=False):
+            game_manager.submit(None, self._prefetch)
+        return idiom, photo
 
     def check_answer(self, guess: str, state: GameState) -> tuple[bool, str]:
-        return guess == state["answer"], evaluate_guess(guess, state["answer"])
+        return guess == state.answer, evaluate_guess(guess, state.answer)
 
+    @run_in_worker
     @handle_exception
     def start_game(self, message: Message) -> None:
         game_state = game_manager.get_state(message.chat.id)
@@ -185,66 +537,45 @@ class GuessIdiom(GuessGame):
             # TODO: per chat state
             bot.reply_to(message, "已经有一个游戏正在进行中")
             return
-        idiom = random.choice(self.idioms)
+        idiom, photo = self._next_idiom()
         game_state = game_manager.start_game(
             message.chat.id,
-            {
-                "answer": idiom,
-                "remain_guesses": self.config["max_guesses"],
-                "revealed": [""] * len(idiom),
-                "min_unrevealed": self.config["min_unrevealed"],
-                "game": self,
-                "context": {},
-            },
+            GameState(
+                answer=idiom,
+                remain_guesses=self.config["max_guesses"],
+                revealed=set(),
+                min_unrevealed=self.config["min_unrevealed"],
+                game=self,
+            ),
+        )
+        prepare = game_manager.submit(
+            None, bot.reply_to, message, "正在准备游戏，请稍等..."
+        )
+        # Draw the picture in the background so the chat isn't held up meanwhile.
+        game_manager.submit(
+            None,
+            self.send_question,
+            message,
+            game_state,
+            f"猜猜这是什么成语？你有 {game_state.remain_guesses} 次机会。",
+            prepare,
+            photo,
         )
-        prepare = bot.reply_to(message, "正在准备游戏，请稍等...")
-        try:
-            image_url = self.generate_image(idiom)
-            bot.send_photo(
-                message.chat.id,
-                image_url,
-                caption=f"猜猜这是什么成语？你有 {game_state['remain_guesses']} 次机会。",
-            )
-        except Exception as e:
-            game_manager.clear_state(message.chat.id)
-            if "content_policy_violation" in str(e):
-                bot.reply_to(
-                    message, "生成图片失败，可能是因为内容不符合政策，请重试。"
-                )
-            else:
-                raise
-        else:
-            bot.delete_message(prepare.chat.id, prepare.message_id)
-
-    def _load_idioms(self) -> list[str]:
-        if not os.path.exists(self.IDIOM_FILE):
-            import httpx
 
+    @classmethod
+    @functools.cache
+    def _load_idioms(cls) -> tuple[str, ...]:
+        # The database is static, so parse it at most once per process.
+        if not os.path.exists(cls.IDIOM_FILE):
             logger.info("Downloading idioms database from THUOCL...")
-            with httpx.Client() as client:
-                with client.stream("GET", self.IDIOM_DATABASE_URL) as response:
-                    response.raise_for_status()
-                    with open(self.IDIOM_FILE, "wb") as f:
-                        for chunk in response.iter_bytes(8192):
-                            f.write(chunk)
+            download_file(cls.IDIOM_DATABASE_URL, cls.IDIOM_FILE)
 
-        with open(self.IDIOM_FILE) as f:
-            return [line.split()[0] for line in f if line.strip()]
-
-    def make_image_prompt(self, word: str) -> str:
-        prompt = f"Explain the chinese idiom {word} to plain text"
-        response = self.openai_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            **self.config["chat"],
-        )
-        logger.debug(
-            "Image prompt for %s: %s", word, response.choices[0].message.content
-        )
-        return response.choices[0].message.content
+        with open(cls.IDIOM_FILE) as f:
+            return tuple(line.split(None, 1)[0] for line in f if line.strip())
 
     def generate_image(self, word: str) -> str:
         result = self.openai_client.images.generate(
-            prompt=self.make_image_prompt(word), model=self.config["model"], n=1
+            prompt=self.get_image_prompt(word), model=self.config["model"], n=1
         )
         if not result.data or not result.data[0].url:
             raise RuntimeError("Failed to generate image")
@@ -264,7 +595,14 @@ class GuessIdiom(GuessGame):
 class GuessPoem(GuessGame):
     POEM_URL = "https://gist.githubusercontent.com/frostming/a7e46994c40a348808a9b3fc28297e2e/raw/gushiwen.json"
     POEM_FILE = os.path.join(DATA_DIR, "gushiwen.json")
+    CACHE_PREFIX = "poem"
+    IMAGE_PROMPT_INSTRUCTIONS = (
+        "Describe the given sentence from chinese poem in plain text, "
+        "it should be fit as a Dall-E image generate prompt."
+    )
     PUNCTUATION = "，。！？,.!?；;、"
+    _PUNCT_TRANS = str.maketrans(dict.fromkeys(PUNCTUATION, " "))
+    _PUNCT_SET = frozenset(PUNCTUATION)
 
     def __init__(self, openai_client: OpenAI) -> None:
         super().__init__(openai_client)
@@ -273,46 +611,45 @@ class GuessPoem(GuessGame):
         self.config["min_unrevealed"] = 5
 
     def render_answer(self, state: GameState) -> str:
-        return f'{state["answer"]}\n出自[{state["context"]["origin"]}]({state["context"]["url"]})'
-
-    def _load_poems(self) -> tuple[list[dict], int]:
-        if not os.path.exists(self.POEM_FILE):
-            import httpx
+        return f'{state.answer}\n出自[{state.context["origin"]}]({state.context["url"]})'
 
+    @classmethod
+    @functools.cache
+    def _load_poems(cls) -> tuple[list[dict], int]:
+        # The database is static, so parse it at most once per process.
+        if not os.path.exists(cls.POEM_FILE):
             logger.info("Downloading poems database from Gist...")
-            with httpx.Client() as client:
-                with client.stream("GET", self.POEM_URL) as response:
-                    response.raise_for_status()
-                    with open(self.POEM_FILE, "wb") as f:
-                        for chunk in response.iter_bytes(8192):
-                            f.write(chunk)
-
-        with open(self.POEM_FILE) as f:
+            download_file(cls.POEM_URL, cls.POEM_FILE)
+
+        with open(cls.POEM_FILE) as f:
             data = json.load(f)
             return data["data"], data["sep"]
 
     def normalize(self, text: str) -> str:
-        return re.sub(rf"[{self.PUNCTUATION}\s]\s*", " ", text).strip()
+        # split() drops the surrounding blanks and collapses runs of separators.
+        return " ".join(text.translate(self._PUNCT_TRANS).split())
 
     def check_answer(self, guess: str, state: GameState) -> tuple[bool, str]:
         guess = self.normalize(guess)
-        golden = self.normalize(state["answer"])
+        golden = state.normalized_answer
         check = list(evaluate_guess(guess, golden))
-        for i, c in enumerate(state["answer"]):
-            if c in self.PUNCTUATION:
-                if i < len(check):
-                    check[i] = c
-                else:
-                    check.append(c)
+        for i, c in state.punctuations:
+            if i < len(check):
+                check[i] = c
+            else:
+                check.append(c)
         return guess == golden, "".join(check)
 
+    @run_in_worker
     @handle_exception
     def start_game(self, message: Message) -> None:
         game_state = game_manager.get_state(message.chat.id)
         if game_state:
             bot.reply_to(message, "已经有一个游戏正在进行中")
             return
-        prepare = bot.reply_to(message, "正在准备游戏，请稍等...")
+        prepare = game_manager.submit(
+            None, bot.reply_to, message, "正在准备游戏，请稍等..."
+        )
         if "hard" in message.text.lower():
             rang = (self.sep, self.total)
         else:
@@ -321,44 +658,33 @@ class GuessPoem(GuessGame):
         logger.debug("Selecting poem %d", idx)
         poem = self.poems[idx]
         line = poem["sentence"]
+        punctuations = [(i, c) for i, c in enumerate(line) if c in self._PUNCT_SET]
         game_state = game_manager.start_game(
             message.chat.id,
-            {
-                "answer": line,
-                "remain_guesses": self.config["max_guesses"],
-                "revealed": ["" if c not in self.PUNCTUATION else c for c in line],
-                "min_unrevealed": self.config["min_unrevealed"],
-                "game": self,
-                "context": poem,
-            },
+            GameState(
+                answer=line,
+                remain_guesses=self.config["max_guesses"],
+                revealed={i for i, _ in punctuations},
+                min_unrevealed=self.config["min_unrevealed"],
+                game=self,
+                context=poem,
+                normalized_answer=self.normalize(line),
+                punctuations=punctuations,
+            ),
         )
-        try:
-            image_url = self.generate_image(line)
-            bot.send_photo(
-                message.chat.id,
-                image_url,
-                caption=f"猜猜这是哪句古诗？你有 {game_state['remain_guesses']} 次机会。",
-            )
-        except Exception:
-            game_manager.clear_state(message.chat.id)
-            raise
-        else:
-            bot.delete_message(prepare.chat.id, prepare.message_id)
-
-    def make_image_prompt(self, sentence: str) -> str:
-        prompt = f"Describe this sentence from chinese poem in plain text, it should be fit as a Dall-E image generate prompt: {sentence}"
-        response = self.openai_client.chat.completions.create(
-            messages=[{"role": "user", "content": prompt}],
-            **self.config["chat"],
-        )
-        logger.debug(
-            "Image prompt for %s: %s", sentence, response.choices[0].message.content
+        # Draw the picture in the background so the chat isn't held up meanwhile.
+        game_manager.submit(
+            None,
+            self.send_question,
+            message,
+            game_state,
+            f"猜猜这是哪句古诗？你有 {game_state.remain_guesses} 次机会。",
+            prepare,
         )
-        return response.choices[0].message.content
 
     def generate_image(self, sentence: str) -> str:
         result = self.openai_client.images.generate(
-            prompt=self.make_image_prompt(sentence) + " in Chinese comic style",
+            prompt=self.get_image_prompt(sentence) + " in Chinese comic style",
             model=self.config["model"],
             n=1,
         )
@@ -377,36 +703,28 @@ class GuessPoem(GuessGame):
         return [BotCommand("guess_p", "开始猜古诗")]
 
 
+@run_in_worker
 @handle_exception
 def show_score(message: Message):
-    board = sorted(
-        game_manager.get_scores(message.chat.id), key=lambda x: x[-1], reverse=True
-    )
+    board = game_manager.get_scores(message.chat.id)
     if not board:
         bot.reply_to(message, "暂无记录")
         return
-    current_user = message.from_user.id
-    current_record = next(
-        (
-            (i, score)
-            for i, (uid, _, score) in enumerate(board, start=1)
-            if uid == current_user
-        ),
-        None,
-    )
+    current_record = game_manager.get_rank(message.from_user.id, message.chat.id)
     if current_record:
         your_status = f"\n\n你的得分：{current_record[1]}, 排名：{current_record[0]}"
     else:
         your_status = ""
     scores = "\n".join(
         f"{i:2d}\. {escape_markdown(name)}: {score}"
-        for i, (_, name, score) in enumerate(board[:20], start=1)
+        for i, (_, name, score) in enumerate(board, start=1)
     )
     bot.reply_to(
         message, f"当前排行榜：\n{scores}{your_status}", parse_mode="MarkdownV2"
     )
 
 
+@run_in_worker
 @handle_exception
 def check_guess(message: Message):
     game_state = game_manager.get_state(message.chat.id)
@@ -414,24 +732,30 @@ def check_guess(message: Message):
         bot.reply_to(message, "没有游戏正在进行中, 请使用 /guess 或 /guess_p 开始游戏")
         return
 
-    if message.text == "提示":
-        to_reveal = [i for i, c in enumerate(game_state["revealed"]) if not c]
-        if len(to_reveal) <= game_state["min_unrevealed"]:
+    guess = (message.text or "").strip()
+    if guess == "提示":
+        revealed = game_state.revealed
+        to_reveal = [i for i in range(len(game_state.answer)) if i not in revealed]
+        if len(to_reveal) <= game_state.min_unrevealed:
             bot.reply_to(message, "已经没有更多提示了")
         else:
-            pos = random.choice(to_reveal)
-            revealed = game_state["answer"][pos]
-            game_state["revealed"][pos] = revealed
-            bot.reply_to(message, "".join(c or ABSENT for c in game_state["revealed"]))
+            revealed.add(random.choice(to_reveal))
+            bot.reply_to(
+                message,
+                "".join(
+                    c if i in revealed else ABSENT
+                    for i, c in enumerate(game_state.answer)
+                ),
+            )
         return
 
-    answer = game_state["game"].render_answer(game_state)
-    if message.text == "答案":
+    answer = game_state.game.render_answer(game_state)
+    if guess == "答案":
         bot.reply_to(message, f"答案是 {answer}", parse_mode="MarkdownV2")
         game_manager.clear_state(message.chat.id)
         return
 
-    success, check = game_state["game"].check_answer(message.text, game_state)
+    success, check = game_state.game.check_answer(guess, game_state)
 
     if success:
         bot.reply_to(
@@ -442,11 +766,11 @@ def check_guess(message: Message):
         game_manager.record_win(message.from_user, message.chat.id)
         game_manager.clear_state(message.chat.id)
     else:
-        game_state["remain_guesses"] -= 1
-        if game_state["remain_guesses"]:
+        game_state.remain_guesses -= 1
+        if game_state.remain_guesses:
             bot.reply_to(
                 message,
-                f"{check}\n猜错啦！还剩 {game_state['remain_guesses']} 次机会。",
+                f"{check}\n猜错啦！还剩 {game_state.remain_guesses} 次机会。",
                 parse_mode="MarkdownV2",
             )
         else:
@@ -469,16 +793,22 @@ def main():
     is_debug = "-d" in sys.argv
     setup_logger(is_debug)
     game_manager.set_debug(is_debug)
+    # telebot creates a session per thread by default; share one pooled session.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50))
+    apihelper.session = session
 
     bot.register_message_handler(
         show_score,
         commands=["score"],
         chat_types=["supergroup"] if not is_debug else None,
     )
+    # Looked up once here rather than at import or on every update.
+    bot.add_custom_filter(ReplyToBotFilter(bot.get_me().id))
     bot.register_message_handler(
         check_guess,
-        func=lambda message: message.reply_to_message is not None
-        and message.reply_to_message.from_user.id == me.id,
+        content_types=["text"],
+        reply_to_bot=True,
         chat_types=["supergroup"] if not is_debug else None,
     )
     openai_client = AzureOpenAI(  # TODO: suppoprt vanilla OpenAI
@@ -493,7 +823,7 @@ def main():
     bot.set_my_commands(my_commands)
 
     logger.info("Bot started.")
-    bot.infinity_polling()
+    bot.infinity_polling(long_polling_timeout=50)
 
 
 if __name__ == "__main__":